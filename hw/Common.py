@@ -6,15 +6,19 @@ _DEBUG_AMARANTH_LFSR = 1
 def print_info(msg: str) -> None:
     print(f"[Info]: {msg}")
 
-def print_debug(msg: str) -> None:
-    """
-    Print message when in DEBUG mode
-    Set _DEBUG_AMARANTH_LFSR to 1 during development and testing.
+if __debug__ and _DEBUG_AMARANTH_LFSR:
+    def print_debug(msg: str) -> None:
+        """
+        Print message when in DEBUG mode
+        Set _DEBUG_AMARANTH_LFSR to 1 during development and testing.
+        With _DEBUG_AMARANTH_LFSR at 0, or under ``python -O``, print_debug is bound to a no-op at import time.
 
-    :param msg: The message to be printed, as a string.
-    """
-    if _DEBUG_AMARANTH_LFSR:
+        :param msg: The message to be printed, as a string.
+        """
         print(f"[Debug]: {msg}")
+else:
+    def print_debug(msg: str) -> None:
+        pass
 
 def print_warning(msg: str) -> None:
     print(f"[Warning]: {msg}")
@@ -25,17 +29,39 @@ def print_error(msg: str) -> None:
 
 def bit_array_to_int(bit_array) -> int:
     """
-    Convert the bit_array to the int64 value
+    Convert the bit_array to the int value
     This function returns the integer value equivalent to the input bit vector.
-    Using a NumPy dot product and shifting operations on powers of two based on an array range `[0, len-1]`.
-    It should be noticed that the max int value is 63 bits for int64.
+    Up to 64 bits (one machine word) are folded with a plain shift/OR loop, walking from MSB to LSB.
+    Wider arrays are gathered into bytes with a single ``np.packbits`` call (LSB first) and read back as a
+    little-endian integer, so no temporary power-of-two array is needed and the result is not limited to 63 bits.
     for example,
        - bit_array: [0, 0, 1, 0] --> 4
        - bit_array: [1, 1]       --> 3
 
-    ---   Inputs: [bit0, bit1, bit2, .... ], max bit63
+    ---   Inputs: [bit0, bit1, bit2, .... ]
+
+    ---   Returns: int -- The decimal number corresponding with given ``bit_array``
+
+    """
+    bits = np.asarray(bit_array)
+    if bits.size <= 64:
+        val = 0
+        for bit in reversed(bits.tolist()):
+            val = (val << 1) | bool(bit)
+        return val
+    # np.packbits takes any integer or bool array as is, without a copy; only other dtypes are reduced to bool
+    if bits.dtype.kind not in "biu":
+        bits = bits != 0
+    return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+
+def reverse_bits(value: int, width: int) -> int:
+    """
+    Reverse the bit order of the ``width`` bits wide value
+    for example,
+       - value: 0b0010, width: 4 --> 0b0100
+       - value: 0b0011, width: 3 --> 0b0110
 
-    ---   Returns: int64 -- The decimal number corresponding with given ``bit_array``
+    ---   Returns: int -- The bit-reversed value
 
     """
-    return int(np.multiply(bit_array.astype(int), 2 ** np.arange(len(bit_array))))
\ No newline at end of file
+    return int(f"{value:0{width}b}"[::-1], 2) if width else 0
@@ -1,4 +1,9 @@
 import argparse
+import functools
+import hashlib
+import os
+from collections import deque
+import amaranth
 from amaranth import *
 from amaranth.back import verilog
 
@@ -159,6 +164,21 @@ class Lfsr_config():
         if self.LFSR_CONFIG not in ["FIBONACCI", "GALOIS"]:
             raise ValueError(f"Invalid configuration '{self.LFSR_CONFIG}', choose FIBONACCI, or GALOIS.")
 
+    def key(self) -> tuple:
+        """
+        The parameters the LFSR depends on, as a tuple:
+        (LFSR_WIDTH, DATA_WIDTH, LFSR_POLY, LFSR_CONFIG, LFSR_FEED_FORWARD, REVERSE)
+        """
+        return (self.LFSR_WIDTH, self.DATA_WIDTH, self.LFSR_POLY, self.LFSR_CONFIG, self.LFSR_FEED_FORWARD, self.REVERSE)
+
+    def __eq__(self, other):
+        if not isinstance(other, Lfsr_config):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
 class Lfsr_config_fibonacci(Lfsr_config):
     """
     A subclass of Lfsr_config with config=="FIBONACCI" predefined.
@@ -183,6 +203,121 @@ class Lfsr_config_galois(Lfsr_config):
                        reverse: bool = False):
         super().__init__(width=width, poly=poly, config="GALOIS", data_width=data_width, feed_forward=feed_forward, reverse=reverse)
 
+def _calc_mask_kernel(lfsr_width: int, data_width: int, poly: int, config: str, feed_forward: bool):
+    """
+    Mask computation kernel of :meth:`Lfsr.calc_mask`, a pure function of the scalar configuration.
+    Each mask row is accumulated as an int (bit j set when bit j of the input is part of the XOR),
+    so a row update is a single int XOR and no bit matrix is ever materialized.
+    REVERSE is applied by the caller.
+
+    :return: (mask_state, mask_data, output_mask_state, output_mask_data) as lists of row ints
+    """
+    # polynomial taps x^j, j in [1, LFSR_WIDTH), the top term is implicit
+    taps = [j for j in range(1, lfsr_width) if (poly>>j) & 1]
+
+    # feedback: fb_taps are the state bits XORed into the feedback bit,
+    #           fb_dest are the state bits other than bit 0 the feedback bit is XORed into
+    # with the taps known here, one shift of the register is a row shift plus XORs of these rows only,
+    # no generic companion matrix product is needed
+    # config is validated by Lfsr_config
+    fb_taps, fb_dest = {
+        "FIBONACCI": ([j-1 for j in taps] + [lfsr_width-1], []),
+        "GALOIS":    ([lfsr_width-1], taps),
+    }[config]
+
+    # fixed masks for data and state, shifting in at the left drops the top row in O(1)
+    mask_state = deque([1<<k for k in range(lfsr_width)], maxlen=lfsr_width)
+    mask_data  = deque([0] * lfsr_width, maxlen=lfsr_width)
+    output_mask_state = [0] * data_width
+    output_mask_data  = [0] * data_width
+
+    for i in range(data_width):
+        data_mask = 1 << (data_width-1-i)
+        # feedback bit of this shift
+        state_val = 0
+        data_val  = data_mask
+        for j in fb_taps:
+            state_val ^= mask_state[j]
+            data_val  ^= mask_data[j]
+
+        # the output shifts by one row per data bit, so this feedback ends up in row DATA_WIDTH-1-i:
+        # write it there directly instead of shifting the whole output
+        output_mask_state[data_width-1-i] = state_val
+        output_mask_data[data_width-1-i]  = data_val
+
+        if (feed_forward):
+            mask_state.appendleft(0)
+            mask_data.appendleft(data_mask)
+            for j in fb_dest:
+                mask_data[j] ^= data_mask
+        else:
+            mask_state.appendleft(state_val)
+            mask_data.appendleft(data_val)
+            for j in fb_dest:
+                mask_state[j] ^= state_val
+                mask_data[j]  ^= data_val
+
+    return list(mask_state), list(mask_data), output_mask_state, output_mask_data
+
+@functools.lru_cache(maxsize=128)
+def _compute_masks(lfsr_width: int, data_width: int, poly: int, config: str, feed_forward: bool, reverse: bool):
+    """
+    Masks of :meth:`Lfsr.calc_mask`, memoized on the configuration so that
+    LFSRs sharing a configuration, or elaborated repeatedly, compute them only once.
+
+    :return: (mask_state, mask_data, output_mask_state, output_mask_data) as tuples of row ints
+    """
+    mask_state, mask_data, output_mask_state, output_mask_data = _calc_mask_kernel(
+        lfsr_width, data_width, poly, config, feed_forward
+    )
+
+    if(reverse):
+        mask_state        = [reverse_bits(row, lfsr_width) for row in mask_state[::-1]]
+        mask_data         = [reverse_bits(row, data_width) for row in mask_data[::-1]]
+        output_mask_state = [reverse_bits(row, lfsr_width) for row in output_mask_state[::-1]]
+        output_mask_data  = [reverse_bits(row, data_width) for row in output_mask_data[::-1]]
+
+    # the masks are shared by every caller of the cache, hand them out as immutable tuples
+    return tuple(mask_state), tuple(mask_data), tuple(output_mask_state), tuple(output_mask_data)
+
+def _compute_mask_columns(lfsr_width: int, data_width: int, poly: int, config: str, feed_forward: bool, reverse: bool):
+    """
+    Columns of the masks of :func:`_compute_masks`, seen as one GF(2) matrix from
+    ``Cat(stat_in, data_in)`` to ``Cat(stat_out, data_out)``, for :meth:`Lfsr.compute`.
+
+    :return: tuple of ints, entry k holds the outputs that input bit k is XORed into
+    """
+    mask_state, mask_data, output_mask_state, output_mask_data = _compute_masks(
+        lfsr_width, data_width, poly, config, feed_forward, reverse
+    )
+    rows = [ms | (md << lfsr_width) for ms, md in zip(mask_state + output_mask_state, mask_data + output_mask_data)]
+    columns = [0] * (lfsr_width + data_width)
+    for i, row in enumerate(rows):
+        while row:
+            low = row & -row
+            columns[low.bit_length() - 1] |= 1 << i
+            row ^= low
+    return tuple(columns)
+
+@functools.lru_cache(maxsize=128)
+def _compute_mask_tables(lfsr_width: int, data_width: int, poly: int, config: str, feed_forward: bool, reverse: bool):
+    """
+    Byte-wise lookup tables of :func:`_compute_mask_columns` for :meth:`Lfsr.compute`:
+    table L, entry v, is the XOR of the columns of the set bits of v in input byte L.
+
+    :return: tuple of 256-entry tuples, one per input byte of ``Cat(stat_in, data_in)``
+    """
+    columns = _compute_mask_columns(lfsr_width, data_width, poly, config, feed_forward, reverse)
+    tables = []
+    for lane in range(0, len(columns), 8):
+        lane_columns = columns[lane:lane+8]
+        table = [0] * 256
+        for v in range(1, 256):
+            low = (v & -v).bit_length() - 1
+            table[v] = table[v & (v-1)] ^ (lane_columns[low] if low < len(lane_columns) else 0)
+        tables.append(tuple(table))
+    return tuple(tables)
+
 class Lfsr(Elaboratable):
     """
     Top module of the LFSR
@@ -210,6 +345,7 @@ class Lfsr(Elaboratable):
                         self.data_out,
                         self.stat_out
                     )
+        self.calc_mask()
 
     def calc_mask(self):
         """
@@ -220,6 +356,8 @@ class Lfsr(Elaboratable):
             next_state[offset] = XOR([mask_state[offset] & stat_in, mask_data[offset] & data_in])
             next_data[offset]  = XOR([output_mask_state[offset] & stat_in, output_mask_data[offset] & data_in])
 
+            each mask row is stored as an int, bit j of the row being column j of the matrices below
+
             for default configuration:
                 DATA_WIDTH = 8
                 LFSR_WIDTH = 31
@@ -275,126 +413,63 @@ class Lfsr(Elaboratable):
                     V
                 DOUT
             """
-        lfsr_width = self.config.LFSR_WIDTH
-        data_width = self.config.DATA_WIDTH
-        # fixed masks for data and state
-        mask_state = np.zeros((lfsr_width, lfsr_width))
-        mask_data  = np.zeros((lfsr_width, data_width))
-        output_mask_state = np.zeros((data_width, lfsr_width))
-        output_mask_data  = np.zeros((data_width, data_width))
-
-        state_val = np.zeros(lfsr_width)
-        data_val  = np.zeros(data_width)
-
-        # init bit mask
-        for i in range(lfsr_width):
-            mask_state[i][i] = 1
-        for i in range(min(data_width, lfsr_width)):
-            output_mask_state[i][i] = 1
-
-        def calc_fibonacci():
-            for i in range(data_width):
-                data_mask = np.zeros(data_width)
-                data_mask[data_width-1-i] = 1
-                state_val = mask_state[lfsr_width-1].copy()
-                data_val  = mask_data[lfsr_width-1].copy()
-                data_val = np.logical_xor(data_val,data_mask)
-
-                for j in range(1, lfsr_width):
-                    if((self.config.LFSR_POLY>>j) & 1):
-                        state_val = np.logical_xor(mask_state[j-1],state_val)
-                        data_val = np.logical_xor(mask_data[j-1],data_val)
-
-                mask_state[1:lfsr_width] = mask_state[0:lfsr_width-1]
-                mask_data[1:lfsr_width] = mask_data[0:lfsr_width-1]
-                output_mask_state[1:data_width] = output_mask_state[0:data_width-1]
-                output_mask_data[1:data_width]  = output_mask_data[0:data_width-1]
-                output_mask_state[0] = state_val.copy()
-                output_mask_data[0]  = data_val.copy()
-
-                if (self.config.LFSR_FEED_FORWARD):
-                    state_val = np.zeros(lfsr_width)
-                    data_val  = data_mask.copy()
-                mask_state[0] = state_val.copy()
-                mask_data[0]  = data_val.copy()
-
-        def calc_galois():
-            for i in range(data_width):
-                data_mask = np.zeros(data_width)
-                data_mask[data_width-1-i] = 1
-                state_val = mask_state[lfsr_width-1].copy()
-                data_val  = mask_data[lfsr_width-1].copy()
-                data_val = 1.0*np.logical_xor(data_val,data_mask)
-
-                mask_state[1:lfsr_width] = mask_state[0:lfsr_width-1]
-                mask_data[1:lfsr_width] = mask_data[0:lfsr_width-1]
-                output_mask_state[1:data_width] = output_mask_state[0:data_width-1]
-                output_mask_data[1:data_width]  = output_mask_data[0:data_width-1]
-                output_mask_state[0] = state_val.copy()
-                output_mask_data[0]  = data_val.copy()
-
-                if (self.config.LFSR_FEED_FORWARD):
-                    state_val = np.zeros(lfsr_width)
-                    data_val  = data_mask.copy()
-                mask_state[0] = state_val.copy()
-                mask_data[0]  = data_val.copy()
-
-                for j in range(1,lfsr_width):
-                    if((self.config.LFSR_POLY>>j) & 1):
-                        mask_state[j] = 1.0*np.logical_xor(mask_state[j],state_val)
-                        mask_data[j] = 1.0*np.logical_xor(mask_data[j],data_val)
-
-        if(self.config.LFSR_CONFIG == "FIBONACCI"):
-            calc_fibonacci()
-        elif(self.config.LFSR_CONFIG == "GALOIS"):
-            calc_galois()
-        else:
-            print("[LFSR]: the input LFSR_CONFIG is not recognized: ", self.config.LFSR_CONFIG)
-            print("        expected: ['FIBONACCI', 'GALOIS']")
-            sys.exit(1)
-
-        if(self.config.REVERSE):
-            mask_state        = mask_state[::-1,::-1]
-            mask_data         = mask_data[::-1,::-1]
-            output_mask_state = output_mask_state[::-1,::-1]
-            output_mask_data  = output_mask_data[::-1,::-1]
-
-        if(0):
-            print(mask_state)
-            print(mask_data)
-            print(output_mask_state)
-            print(output_mask_data)
-        self.mask_state = mask_state.astype(int)
-        self.mask_data  = mask_data.astype(int)
-        self.output_mask_state = output_mask_state.astype(int)
-        self.output_mask_data  = output_mask_data.astype(int)
+        # the caches are keyed on a snapshot of the configuration, so a config changed later cannot alias an entry
+        config = self.config.key()
+        self.mask_state, self.mask_data, self.output_mask_state, self.output_mask_data = _compute_masks(*config)
+        # the lookup tables of compute() are only built once compute() is used
+        self._mask_config = config
+        self._mask_tables = None
+
+    def compute(self, data_in: int, stat_in: int = -1):
+        """
+        Software model of the module, computes one cycle of the LFSR in Python.
+        The masks form a GF(2) matrix over the inputs ``Cat(stat_in, data_in)``,
+        so the outputs are the XOR of the matrix columns selected by the set input bits,
+        looked up a byte at a time from precomputed tables.
+
+        :param data_in: int value of data_in
+        :param stat_in: int value of stat_in, the LFSR/CRC current state, all ones by default.
+                        Feed the returned stat_out back in to stream several data words through one instance.
+        :return: (stat_out, data_out) as ints
+        """
+        # split the inputs and outputs by the widths the masks were computed for
+        lfsr_width, data_width = self._mask_config[:2]
+        inputs = (stat_in & ((1 << lfsr_width) - 1)) | ((data_in & ((1 << data_width) - 1)) << lfsr_width)
+        if self._mask_tables is None:
+            self._mask_tables = _compute_mask_tables(*self._mask_config)
+        outputs = 0
+        for table in self._mask_tables:
+            outputs ^= table[inputs & 0xff]
+            inputs >>= 8
+        return outputs & ((1 << lfsr_width) - 1), outputs >> lfsr_width
 
     def elaborate(self, platform):
-        self.calc_mask()
         # start the logic part
         m = Module()
 
-        def mat_to_sigarr(mat):
-            xlen = mat.shape[1]
-            ylen = mat.shape[0]
-            sigarr = Array([Signal(xlen) for i in range(ylen)])
-            for i in range(ylen):
-                m.d.comb += [sigarr[i].eq(0)]
-                for j in range(xlen):
-                    if(mat[i][j]>0):
-                        m.d.comb += [sigarr[i][j].eq(1)]
-            return sigarr
-
-        mask_state = mat_to_sigarr(self.mask_state)
-        mask_data  = mat_to_sigarr(self.mask_data)
-        for i in range(self.config.LFSR_WIDTH):
-            m.d.comb += [self.stat_out[i].eq(Cat(self.stat_in & mask_state[i], self.data_in & mask_data[i]).xor())
-                        ]
-        mask_state_dout = mat_to_sigarr(self.output_mask_state)
-        mask_data_dout  = mat_to_sigarr(self.output_mask_data)
-        for i in range(self.config.DATA_WIDTH):
-            m.d.comb += [self.data_out[i].eq(Cat(self.stat_in & mask_state_dout[i], self.data_in & mask_data_dout[i]).xor())
-                        ]
+        # every output bit is the XOR of a subset of the bits of Cat(stat_in, data_in);
+        # the masks are known at elaboration time, so XOR exactly the selected bits
+        # instead of masking the full-width inputs with a constant
+        lfsr_width = self.config.LFSR_WIDTH
+        in_bits = [self.stat_in[j] for j in range(lfsr_width)] + \
+                  [self.data_in[j] for j in range(self.config.DATA_WIDTH)]
+
+        def xor_outputs(out, rows_state, rows_data):
+            stmts = []
+            for i, (ms, md) in enumerate(zip(rows_state, rows_data)):
+                mask = ms | (md << lfsr_width)
+                taps = [in_bits[j] for j in range(len(in_bits)) if (mask >> j) & 1]
+                if len(taps) > 1:
+                    stmts.append(out[i].eq(Cat(*taps).xor()))
+                elif taps:
+                    # a one-hot mask, e.g. the plain shift rows, is a wire from that input bit
+                    stmts.append(out[i].eq(taps[0]))
+                else:
+                    stmts.append(out[i].eq(Const(0, 1)))
+            return stmts
+
+        m.d.comb += xor_outputs(self.stat_out, self.mask_state, self.mask_data)
+        m.d.comb += xor_outputs(self.data_out, self.output_mask_state, self.output_mask_data)
         return m
         
 
@@ -406,6 +481,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--no-src", dest="emit_src", default=True, action="store_false",
         help="suppress generation of source location attributes")
+    parser.add_argument("--force", default=False, action="store_true",
+        help="regenerate the verilog even if the configuration is unchanged")
+    args = parser.parse_args()
     cfg = Lfsr_config(
         width=32,
         poly=0x1edc6f41,
@@ -413,7 +491,24 @@ if __name__ == '__main__':
         config = 'GALOIS',
         reverse=1
     )
+
+    # skip the elaboration and export when neither the configuration, the generator sources nor the amaranth version changed
+    out_path = "./hw/gen/Lfsr.v"
+    key_path = out_path + ".key"
+    key = hashlib.sha1(repr((cfg.key(), args.emit_src, amaranth.__version__)).encode())
+    for src in (__file__, sys.modules["hw.Common"].__file__):
+        with open(src, "rb") as f:
+            key.update(f.read())
+    key = key.hexdigest()
+    if not args.force and os.path.exists(out_path) and os.path.exists(key_path):
+        with open(key_path) as f:
+            if f.read() == key:
+                print_info(f"{out_path} is up to date")
+                sys.exit(0)
+
     top = Lfsr(cfg)
-    
-    with open("./hw/gen/Lfsr.v", "w") as f:
-        f.write(verilog.convert(top, ports=top.ports,emit_src=parser.parse_args().emit_src))
\ No newline at end of file
+    with open(out_path + ".tmp", "w") as f:
+        f.write(verilog.convert(top, ports=top.ports,emit_src=args.emit_src))
+    os.replace(out_path + ".tmp", out_path)
+    with open(key_path, "w") as f:
+        f.write(key)
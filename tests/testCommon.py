@@ -0,0 +1,20 @@
+import numpy as np
+from unittest import TestCase
+from hw.Common import bit_array_to_int, reverse_bits
+
+
+class TestCommon(TestCase):
+    def test_bit_array_to_int(self):
+        self.assertEqual(bit_array_to_int(np.array([0, 0, 1, 0])), 4)
+        self.assertEqual(bit_array_to_int(np.array([1, 1])), 3)
+        self.assertEqual(bit_array_to_int(np.array([])), 0)
+
+    def test_bit_array_to_int_wide(self):
+        bits = np.zeros(70, dtype=int)
+        bits[[0, 63, 69]] = 1
+        self.assertEqual(bit_array_to_int(bits), (1 << 69) | (1 << 63) | 1)
+
+    def test_reverse_bits(self):
+        self.assertEqual(reverse_bits(0b0010, 4), 0b0100)
+        self.assertEqual(reverse_bits(0b0011, 3), 0b0110)
+        self.assertEqual(reverse_bits(1, 70), 1 << 69)
@@ -1,13 +1,29 @@
 from os import stat
 import numpy as np
 from unittest import TestCase
+from amaranth import Module
 from amaranth.sim import Simulator, Settle
 from amaranth.lib import crc
 from numpy.lib.polynomial import poly
-from hw.Lfsr.Lfsr import Lfsr, Lfsr_config_fibonacci, Lfsr_config_galois
+from hw.Lfsr.Lfsr import Lfsr, Lfsr_config_fibonacci, Lfsr_config_galois, _compute_masks
 
+import os
 import zlib
+import contextlib
+import functools
 import itertools
+import random
+
+# number of cycles simulated on the elaborated design, longer sequences are checked on Lfsr.compute
+SIM_CYCLES = 16
+
+def vcd_writer(sim, path):
+    """
+    Dump the waveform to ``path`` only when AMARANTH_LFSR_VCD is set, VCD writing dominates the simulation time
+    """
+    if os.environ.get("AMARANTH_LFSR_VCD"):
+        return sim.write_vcd(path)
+    return contextlib.nullcontext()
 
 def chunks(lst, n, padvalue=None):
     return itertools.zip_longest(*[iter(lst)]*n, fillvalue=padvalue)
@@ -15,93 +31,118 @@ def chunks(lst, n, padvalue=None):
 def crc32(data):
     return zlib.crc32(data) & 0xffffffff
 
-def crc32c(data, crc=0xffffffff, poly=0x1edc6f41):
+@functools.lru_cache(maxsize=None)
+def crc32c_table(poly_reverse):
     """
-    When errors, poly can be set to 0x10000001/0x00000003 for step by step debug
-    0x1edc6f41
+    Byte-wise lookup table of the bit-reversed CRC32 with ``poly_reverse``
     """
-    poly_reverse = int(np.binary_repr(poly,32)[::-1],2)
-    for d in data:
-        crc = crc ^ d
+    table = []
+    for b in range(256):
+        crc = b
         for bit in range(0, 8):
             if crc & 1:
                 crc = (crc >> 1) ^ poly_reverse
             else:
                 crc = crc >> 1
+        table.append(crc)
+    return table
+
+def crc32c(data, crc=0xffffffff, poly=0x1edc6f41):
+    """
+    When errors, poly can be set to 0x10000001/0x00000003 for step by step debug
+    0x1edc6f41
+    """
+    poly_reverse = int(np.binary_repr(poly,32)[::-1],2)
+    table = crc32c_table(poly_reverse)
+    for d in data:
+        crc = table[(crc ^ d) & 0xff] ^ (crc >> 8)
     return ~crc & 0xffffffff
 
-def crc_tb(cfg,reffunc):
-    dut = Lfsr(cfg)
+def crc_tb(dut,reffunc):
+    cfg = dut.config
     byte_lanes = cfg.DATA_WIDTH // 8
     data_mask = 2**(cfg.DATA_WIDTH) - 1
     state_mask = 2**(cfg.LFSR_WIDTH) - 1
+    ref_dblock = bytearray(itertools.islice(itertools.cycle(range(256)),1024))
+    # the message as data_in words, converted once for both the simulation and the software model
+    ref_words = [int.from_bytes(b,'little') for b in chunks(ref_dblock, byte_lanes)]
+    # the first words of the message only hold bytes below 0x80, so the simulation drives seeded random words instead
+    rng = random.Random(cfg.DATA_WIDTH)
+    sim_words = [rng.getrandbits(cfg.DATA_WIDTH) for i in range(SIM_CYCLES)]
 
     def process():
-        ref_dblock  = bytes([(x+1)*0x11 for x in range(byte_lanes)])
-        ref_din  = int.from_bytes(ref_dblock, 'little')
+        smoke_dblock = bytes([(x+1)*0x11 for x in range(byte_lanes)])
+        ref_din  = int.from_bytes(smoke_dblock, 'little')
         yield dut.data_in.eq(ref_din)
         yield dut.stat_in.eq(state_mask)
         yield Settle()
         stateout = yield dut.stat_out
         val = ~stateout & state_mask
-        ref = reffunc(ref_dblock)
+        ref = reffunc(smoke_dblock)
         if(0):
             print("%s"%bin(val)[2:].zfill(cfg.LFSR_WIDTH))
             print(f'CRC: {val:08x}, expected = {ref:08x} @ DIN = {ref_din:08x}')
         assert (ref==val), \
                 f'CRC: {val:08x}, expected = {ref:08x} @ DIN = {ref_din:08x}'
 
-        ref_dblock = bytearray(itertools.islice(itertools.cycle(range(256)),1024))
+        # the simulated hardware is checked against the software model cycle by cycle
+        stateref = state_mask
         yield dut.stat_in.eq(state_mask)
-        for b in chunks(ref_dblock, byte_lanes):
-            yield dut.data_in.eq(int.from_bytes(b,'little'))
+        for i, din in enumerate(sim_words):
+            yield dut.data_in.eq(din)
             yield Settle()
             stateout = yield dut.stat_out
+            stateref, _ = dut.compute(din, stateref)
+            assert (stateref==stateout), \
+                    f'CRC state: {stateout:08x}, expected = {stateref:08x} @ iteration = {i:08x}'
             yield dut.stat_in.eq(stateout)
 
-        val = ~stateout & state_mask
-        ref = reffunc(ref_dblock)
-        if(0):
-            print("%s"%bin(val)[2:].zfill(cfg.LFSR_WIDTH))
-            print(f'CRC: {val:08x}, expected = {ref:08x}')
-        assert (ref==val), \
-                f'CRC: {val:08x}, expected = {ref:08x}'
-
     sim = Simulator(dut)
-    with sim.write_vcd("./tests/waveform/test_lfsr_"+reffunc.__name__+".vcd"):
+    with vcd_writer(sim, "./tests/waveform/test_lfsr_"+reffunc.__name__+".vcd"):
         sim.add_process(process)
         sim.run()
 
+    # the whole message runs on the software model of the same masks
+    stateout = state_mask
+    for din in ref_words:
+        stateout, _ = dut.compute(din, stateout)
+
+    val = ~stateout & state_mask
+    ref = reffunc(ref_dblock)
+    if(0):
+        print("%s"%bin(val)[2:].zfill(cfg.LFSR_WIDTH))
+        print(f'CRC: {val:08x}, expected = {ref:08x}')
+    assert (ref==val), \
+            f'CRC: {val:08x}, expected = {ref:08x}'
+
 def prbs9(state=0x1ff):
     while True:
         for i in range(8):
-            if bool(state & 0x10) ^ bool(state & 0x100):
-                state = ((state & 0xff) << 1) | 1
-            else:
-                state = (state & 0xff) << 1
+            fb = ((state >> 8) ^ (state >> 4)) & 1
+            state = ((state << 1) | fb) & 0x1ff
         yield ~state & 0xff
 
 def prbs31(state=0x7fffffff):
     while True:
         for i in range(8):
-            if bool(state & 0x08000000) ^ bool(state & 0x40000000):
-                state = ((state & 0x3fffffff) << 1) | 1
-            else:
-                state = (state & 0x3fffffff) << 1
+            fb = ((state >> 30) ^ (state >> 27)) & 1
+            state = ((state << 1) | fb) & 0x7fffffff
         yield ~state & 0xff
 
-def prbs_tb(cfg,reffunc):
-    dut = Lfsr(cfg)
+def prbs_tb(dut,reffunc):
+    cfg = dut.config
     byte_lanes = cfg.DATA_WIDTH // 8
     data_mask = 2**(cfg.DATA_WIDTH) - 1
     state_mask = 2**(cfg.LFSR_WIDTH) - 1
 
+    # the first cycles run on the simulated hardware
     gen = chunks(reffunc(), byte_lanes)
 
     def process():
+        stateref = state_mask
         yield dut.data_in.eq(0)
         yield dut.stat_in.eq(state_mask)
-        for i in range(512):
+        for i in range(SIM_CYCLES):
             yield Settle()
             ref = int.from_bytes(bytes(next(gen)), 'big')
             dataout = yield dut.data_out
@@ -111,86 +152,164 @@ def prbs_tb(cfg,reffunc):
                 print("%s"%bin(val)[2:].zfill(cfg.DATA_WIDTH))
             assert (ref==val), \
                     f'PRBS: {val:08x}, expected = {ref:08x} @ iteration = {i:08x}'
+            stateref, _ = dut.compute(0, stateref)
+            assert (stateref==stateout), \
+                    f'PRBS state: {stateout:08x}, expected = {stateref:08x} @ iteration = {i:08x}'
 
             yield dut.stat_in.eq(stateout)
         
     sim = Simulator(dut)
-    with sim.write_vcd("./tests/waveform/test_lfsr_"+reffunc.__name__+".vcd"):
+    with vcd_writer(sim, "./tests/waveform/test_lfsr_"+reffunc.__name__+".vcd"):
         sim.add_process(process)
         sim.run()
 
+    # the whole sequence runs on the software model of the same masks
+    gen = chunks(reffunc(), byte_lanes)
+    stateout = state_mask
+    for i in range(512):
+        ref = int.from_bytes(bytes(next(gen)), 'big')
+        stateout, dataout = dut.compute(0, stateout)
+        val = ~dataout & data_mask
+        assert (ref==val), \
+                f'PRBS: {val:08x}, expected = {ref:08x} @ iteration = {i:08x}'
+
+
+# configurations shared by the test methods, elaborated once per TestLfsr run
+CONFIGS = {
+    "CRC32":        Lfsr_config_galois(width=32, poly=0x4c11db7, data_width=8, reverse=1),
+    "CRC32_DW64":   Lfsr_config_galois(width=32, poly=0x4c11db7, data_width=64, reverse=1),
+    "CRC32C":       Lfsr_config_galois(width=32, poly=0x1edc6f41, data_width=8, reverse=1),    #poly=0x00000003
+    "CRC32C_DW64":  Lfsr_config_galois(width=32, poly=0x1edc6f41, data_width=64, reverse=1),   #poly=0x0000003f
+    "PRBS9":        Lfsr_config_fibonacci(width=9, poly=0x021, data_width=8, reverse=0),
+    "PRBS9_DW64":   Lfsr_config_fibonacci(width=9, poly=0x021, data_width=64, reverse=0),
+    "PRBS31":       Lfsr_config_fibonacci(width=31, poly=0x10000001, data_width=8, reverse=0),
+    "PRBS31_D64":   Lfsr_config_fibonacci(width=31, poly=0x10000001, data_width=64, reverse=0),
+}
 
 class TestLfsr(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.duts = {name: Lfsr(cfg) for name, cfg in CONFIGS.items()}
+
     def test_CRC32(self):
-        cfg = Lfsr_config_galois(
-            width=32,
-            poly=0x4c11db7,
-            data_width=8,
-            reverse=1
-        )
-        crc_tb(cfg, crc32)
+        crc_tb(self.duts["CRC32"], crc32)
 
     def test_CRC32_DW64(self):
-        cfg = Lfsr_config_galois(
-            width=32,
-            poly=0x4c11db7,
-            data_width=64,
-            reverse=1
-        )
-        crc_tb(cfg, crc32)
+        crc_tb(self.duts["CRC32_DW64"], crc32)
 
     def test_CRC32C(self):
-        cfg = Lfsr_config_galois(
-            width=32,
-            poly=0x1edc6f41,
-            #poly=0x00000003,
-            data_width=8,
-            reverse=1
-        )
-        crc_tb(cfg, crc32c)
+        crc_tb(self.duts["CRC32C"], crc32c)
 
     def test_CRC32C_DW64(self):
-        cfg = Lfsr_config_galois(
-            width=32,
-            poly=0x1edc6f41,
-            #poly=0x0000003f,
-            data_width=64,
-            reverse=1
-        )
-        crc_tb(cfg, crc32c)
+        crc_tb(self.duts["CRC32C_DW64"], crc32c)
 
     def test_PRBS9(self):
-        cfg = Lfsr_config_fibonacci(
-            width=9,
-            poly=0x021,
-            data_width=8,
-            reverse=0
-        )
-        prbs_tb(cfg, prbs9)
+        prbs_tb(self.duts["PRBS9"], prbs9)
 
     def test_PRBS9_DW64(self):
-        cfg = Lfsr_config_fibonacci(
-            width=9,
-            poly=0x021,
-            data_width=64,
-            reverse=0
-        )
-        prbs_tb(cfg, prbs9)
+        prbs_tb(self.duts["PRBS9_DW64"], prbs9)
 
     def test_PRBS31(self):
-        cfg = Lfsr_config_fibonacci(
-            width=31,
-            poly=0x10000001,
-            data_width=8,
-            reverse=0
-        )
-        prbs_tb(cfg, prbs31)
+        prbs_tb(self.duts["PRBS31"], prbs31)
 
     def test_PRBS31_D64(self):
-        cfg = Lfsr_config_fibonacci(
-            width=31,
-            poly=0x10000001,
-            data_width=64,
-            reverse=0
-        )
-        prbs_tb(cfg, prbs31)
\ No newline at end of file
+        prbs_tb(self.duts["PRBS31_D64"], prbs31)
+
+    def test_compute_CRC32(self):
+        dut = self.duts["CRC32"]
+        ref_dblock = bytes(range(256))
+        state, _ = dut.compute(ref_dblock[0])
+        for b in ref_dblock[1:]:
+            state, _ = dut.compute(b, state)
+        self.assertEqual(~state & 0xffffffff, crc32(ref_dblock))
+
+    def test_compute_PRBS31(self):
+        dut = self.duts["PRBS31"]
+        gen = prbs31()
+        state = 0x7fffffff
+        for i in range(64):
+            state, dataout = dut.compute(0, state)
+            self.assertEqual(~dataout & 0xff, next(gen))
+
+    def test_scrambler(self):
+        # a feed-forward instance descrambles what the plain instance of the same polynomial scrambled
+        rng = random.Random(9)
+        for lfsr_config in (Lfsr_config_fibonacci, Lfsr_config_galois):
+            for reverse in (0, 1):
+                scr = Lfsr(lfsr_config(width=9, poly=0x021, data_width=8, reverse=reverse))
+                dscr = Lfsr(lfsr_config(width=9, poly=0x021, data_width=8, feed_forward=1, reverse=reverse))
+                words = [rng.getrandbits(8) for i in range(256)]
+
+                scr_state = dscr_state = 0x1ff
+                for i, din in enumerate(words):
+                    scr_state, scrambled = scr.compute(din, scr_state)
+                    dscr_state, dataout = dscr.compute(scrambled, dscr_state)
+                    self.assertEqual(dataout, din, f'{lfsr_config.__name__}, reverse = {reverse} @ iteration = {i}')
+
+                # the first cycles run on the simulated scrambler and descrambler, checked against the software model
+                def process():
+                    scr_ref = dscr_ref = 0x1ff
+                    yield scr.stat_in.eq(scr_ref)
+                    yield dscr.stat_in.eq(dscr_ref)
+                    for i, din in enumerate(words[:SIM_CYCLES]):
+                        yield scr.data_in.eq(din)
+                        yield Settle()
+                        scrambled = yield scr.data_out
+                        yield dscr.data_in.eq(scrambled)
+                        yield Settle()
+                        dataout = yield dscr.data_out
+                        scr_ref, scr_dref = scr.compute(din, scr_ref)
+                        dscr_ref, dscr_dref = dscr.compute(scrambled, dscr_ref)
+                        self.assertEqual(dataout, din, f'iteration = {i}')
+                        self.assertEqual(((yield scr.stat_out), scrambled), (scr_ref, scr_dref), f'iteration = {i}')
+                        self.assertEqual(((yield dscr.stat_out), dataout), (dscr_ref, dscr_dref), f'iteration = {i}')
+                        yield scr.stat_in.eq(scr_ref)
+                        yield dscr.stat_in.eq(dscr_ref)
+
+                top = Module()
+                top.submodules.scr = scr
+                top.submodules.dscr = dscr
+                sim = Simulator(top)
+                sim.add_process(process)
+                sim.run()
+
+    def test_compute_wide(self):
+        # one 8-bit step of an 80-bit LFSR must match eight 1-bit steps, MSB first
+        cfg8 = Lfsr_config_galois(width=80, poly=(1<<64)|0x21, data_width=8)
+        cfg1 = Lfsr_config_galois(width=80, poly=(1<<64)|0x21, data_width=1)
+        dut8, dut1 = Lfsr(cfg8), Lfsr(cfg1)
+        state8 = state1 = 2**80 - 1
+        for b in range(256):
+            state8, _ = dut8.compute(b, state8)
+            for k in reversed(range(8)):
+                state1, _ = dut1.compute((b>>k) & 1, state1)
+            self.assertEqual(state8, state1)
+
+        # the elaborated 80-bit designs must agree with the software model
+        rng = random.Random(80)
+        for dut in (dut8, dut1):
+            vectors = [(rng.getrandbits(dut.config.DATA_WIDTH), rng.getrandbits(80)) for i in range(SIM_CYCLES)]
+
+            def process():
+                for i, (din, sin) in enumerate(vectors):
+                    yield dut.data_in.eq(din)
+                    yield dut.stat_in.eq(sin)
+                    yield Settle()
+                    stateout = yield dut.stat_out
+                    dataout = yield dut.data_out
+                    self.assertEqual((stateout, dataout), dut.compute(din, sin), f'iteration = {i}')
+
+            sim = Simulator(dut)
+            sim.add_process(process)
+            sim.run()
+
+    def test_config_key(self):
+        cfg = Lfsr_config_galois(width=32, poly=0x4c11db7, data_width=8, reverse=1)
+        same = Lfsr_config_galois(width=32, poly=0x4c11db7, data_width=8, reverse=True)
+        other = Lfsr_config_galois(width=32, poly=0x4c11db7, data_width=64, reverse=1)
+        self.assertEqual(cfg, same)
+        self.assertEqual(hash(cfg), hash(same))
+        self.assertNotEqual(cfg, other)
+        self.assertIs(cfg.__eq__(cfg.key()), NotImplemented)
+        self.assertIs(_compute_masks(*cfg.key()), _compute_masks(*same.key()))
+        self.assertIs(self.duts["CRC32"].mask_state, _compute_masks(*same.key())[0])